@@ -2,11 +2,19 @@ from __future__ import annotations
 
 import os
 import csv
-from datetime import datetime, date
+import hmac
+import re
+import sqlite3
+import tempfile
+import threading
+import zlib
+from datetime import date
 from calendar import monthrange
-from io import StringIO, BytesIO
-from functools import wraps
+from io import BytesIO, TextIOWrapper
+from functools import lru_cache, wraps
+from typing import Iterable, Iterator
 
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 from flask import (
@@ -16,13 +24,17 @@ from flask import (
     redirect,
     url_for,
     flash,
+    g,
     Response,
     send_file,
     abort,
     session,
+    stream_with_context,
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import bindparam, event, func, insert, inspect, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 
 # PDF (Monthly close)
 from reportlab.lib.pagesizes import A4
@@ -42,6 +54,10 @@ ADMIN_PASSWORD = os.getenv("BAR_ADMIN_PASSWORD")
 if not ADMIN_USERNAME or not ADMIN_PASSWORD:
     raise RuntimeError("Missing BAR_ADMIN_USERNAME or BAR_ADMIN_PASSWORD in .env file")
 
+# Encoded once so login() can compare bytes without re-encoding per request.
+ADMIN_USERNAME_B = ADMIN_USERNAME.encode()
+ADMIN_PASSWORD_B = ADMIN_PASSWORD.encode()
+
 SECRET_KEY = os.getenv("BAR_SECRET_KEY")
 if not SECRET_KEY:
     raise RuntimeError("Missing BAR_SECRET_KEY in .env file")
@@ -61,9 +77,28 @@ os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_PATH = os.path.join(DATA_DIR, "barbook.db")
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + DB_PATH
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": True,
+    "connect_args": {"check_same_thread": False},
+}
 
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a Gunicorn worker writes; NORMAL sync is
+    # safe under WAL and avoids an fsync per commit.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 # -------------------
 # Models
 # -------------------
@@ -74,27 +109,61 @@ class DailySale(db.Model):
     sale_date = db.Column(db.Date, nullable=False, index=True, unique=True)
     total_sales = db.Column(db.Float, nullable=False)
     daily_profit = db.Column(db.Float, nullable=False)
-
-    @property
-    def day_name(self) -> str:
-        return self.sale_date.strftime("%A")
+    # Stored at write time so exports and reports don't format it per row.
+    day_name = db.Column(db.String(9), nullable=False)
 
 
 class Expense(db.Model):
     __tablename__ = "expenses"
+    # Range scans filter on expense_date and order by (expense_date, id);
+    # the composite index lets SQLite walk it in order without a sort step.
+    __table_args__ = (db.Index("ix_expense_date_id", "expense_date", "id"),)
 
     id = db.Column(db.Integer, primary_key=True)
-    expense_date = db.Column(db.Date, nullable=False, index=True)
+    expense_date = db.Column(db.Date, nullable=False)
     description = db.Column(db.String(255), nullable=False)
     amount = db.Column(db.Float, nullable=False)
 
+# -------------------
+# Caches
+# -------------------
+# Per-process caches keyed by "YYYY-MM". Writes call invalidate_months()
+# so the next request for an affected month rebuilds from the database.
+# Other Gunicorn workers aren't told, so every cache also has a TTL that
+# bounds how long they can serve a stale month.
+_PDF_CACHE = TTLCache(maxsize=64, ttl=60)  # rendered PDFs, current month
+_CLOSED_PDF_CACHE = TTLCache(maxsize=128, ttl=600)  # rendered PDFs, past months
+_SUMMARY_CACHE = TTLCache(maxsize=24, ttl=30)  # /summary template context
+_cache_lock = threading.Lock()
+# Bumped per month by invalidate_months(). A render is only cached if its
+# month's generation is unchanged, so a write committed mid-render wins.
+_month_generation: dict[str, int] = {}
+
+
+def invalidate_months(*days: date) -> None:
+    with _cache_lock:
+        for d in days:
+            key = d.strftime("%Y-%m")
+            _month_generation[key] = _month_generation.get(key, 0) + 1
+            _PDF_CACHE.pop(key, None)
+            _CLOSED_PDF_CACHE.pop(key, None)
+            _SUMMARY_CACHE.pop(key, None)
+
 # -------------------
 # Helpers
 # -------------------
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}", re.ASCII)
+
+
 def parse_date(value: str) -> date:
-    return datetime.strptime(value, "%Y-%m-%d").date()
+    # fromisoformat also takes forms like 20260901 and 2026-W36-2 on 3.11+;
+    # only the plain YYYY-MM-DD shape is a valid entry date here.
+    if not _ISO_DATE_RE.fullmatch(value):
+        raise ValueError(f"Invalid date {value!r}; expected YYYY-MM-DD.")
+    return date.fromisoformat(value)
 
 
+@lru_cache(maxsize=128)
 def month_bounds(yyyy_mm: str):
     y, m = map(int, yyyy_mm.split("-"))
     start = date(y, m, 1)
@@ -102,24 +171,80 @@ def month_bounds(yyyy_mm: str):
     return start, end
 
 
-def csv_response(filename: str, header: list[str], rows: list[list[str]]) -> Response:
-    buf = StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(header)
-    for r in rows:
-        writer.writerow(r)
-    data = buf.getvalue()
-    return Response(
-        data,
-        mimetype="text/csv",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+class Echo:
+    """Pseudo-buffer for csv.writer: write() hands the formatted line straight back."""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def month_totals(start: date, end: date) -> tuple[float, float, float]:
+    """Return (total_sales, total_profit, total_expenses) for the date range in two queries."""
+    total_sales, total_profit = (
+        db.session.query(
+            func.coalesce(func.sum(DailySale.total_sales), 0.0),
+            func.coalesce(func.sum(DailySale.daily_profit), 0.0),
+        )
+        .filter(DailySale.sale_date.between(start, end))
+        .one()
+    )
+    total_expenses = (
+        db.session.query(func.coalesce(func.sum(Expense.amount), 0.0))
+        .filter(Expense.expense_date.between(start, end))
+        .scalar()
     )
+    return total_sales, total_profit, total_expenses
+
+
+def month_rows(start: date, end: date):
+    """Sales and expense rows for the date range as plain Core rows (no ORM hydration)."""
+    sales_rows = db.session.execute(
+        select(DailySale.sale_date, DailySale.day_name, DailySale.total_sales, DailySale.daily_profit)
+        .where(DailySale.sale_date.between(start, end))
+        .order_by(DailySale.sale_date.asc())
+    ).all()
+    expense_rows = db.session.execute(
+        select(Expense.expense_date, Expense.description, Expense.amount)
+        .where(Expense.expense_date.between(start, end))
+        .order_by(Expense.expense_date.asc(), Expense.id.asc())
+    ).all()
+    return sales_rows, expense_rows
+
+
+def csv_response(filename: str, header: list[str], rows: Iterable[list[str]]) -> Response:
+    writer = csv.writer(Echo())
+
+    def generate():
+        yield writer.writerow(header)
+        for r in rows:
+            yield writer.writerow(r)
+
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Vary": "Accept-Encoding",
+    }
+    body = generate()
+    if request.accept_encodings["gzip"]:
+        headers["Content-Encoding"] = "gzip"
+        body = gzip_stream(body)
+
+    return Response(stream_with_context(body), mimetype="text/csv", headers=headers)
+
+
+def gzip_stream(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Gzip text chunks incrementally, yielding compressed bytes as zlib emits them."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 def login_required_simple(view_func):
     @wraps(view_func)
     def wrapper(*args, **kwargs):
-        if not session.get("is_admin"):
+        if not g.is_admin:
             return redirect(url_for("login", next=request.path))
         return view_func(*args, **kwargs)
 
@@ -128,16 +253,26 @@ def login_required_simple(view_func):
 # -------------------
 # Auth routes (Session-based)
 # -------------------
+@app.before_request
+def load_admin_flag():
+    # Resolve the session once per request; views and decorators read g.
+    g.is_admin = bool(session.get("is_admin"))
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
-    if session.get("is_admin"):
+    if g.is_admin:
         return redirect(url_for("summary"))
 
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
 
-        if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+        # Constant-time compare; `&` so both checks always run.
+        ok = hmac.compare_digest(username.encode(), ADMIN_USERNAME_B) & hmac.compare_digest(
+            password.encode(), ADMIN_PASSWORD_B
+        )
+        if ok:
             session["is_admin"] = True
             flash("Logged in successfully.", "success")
             return redirect(request.args.get("next") or url_for("summary"))
@@ -161,6 +296,10 @@ def logout():
 def home():
     return redirect(url_for("summary"))
 
+# List views fetch one extra row to know whether an older page exists.
+SALES_PER_PAGE = 90
+EXPENSES_PER_PAGE = 150
+
 # ---- Sales ----
 @app.route("/sales", methods=["GET", "POST"])
 @login_required_simple
@@ -174,29 +313,49 @@ def sales():
             if total_sales < 0 or daily_profit < 0:
                 raise ValueError("Values must be non-negative.")
 
-            existing = DailySale.query.filter_by(sale_date=d).first()
-            if existing:
-                existing.total_sales = total_sales
-                existing.daily_profit = daily_profit
-                flash(f"Updated sale for {d}.", "info")
-            else:
-                db.session.add(
-                    DailySale(
-                        sale_date=d,
-                        total_sales=total_sales,
-                        daily_profit=daily_profit,
-                    )
-                )
-                flash(f"Added sale for {d}.", "success")
-
+            # One statement for both cases: insert, or overwrite the existing
+            # entry for that date via the unique sale_date index.
+            stmt = sqlite_insert(DailySale).values(
+                sale_date=d,
+                day_name=d.strftime("%A"),
+                total_sales=total_sales,
+                daily_profit=daily_profit,
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[DailySale.sale_date],
+                set_={
+                    "total_sales": stmt.excluded.total_sales,
+                    "daily_profit": stmt.excluded.daily_profit,
+                },
+            )
+            db.session.execute(stmt)
             db.session.commit()
+            invalidate_months(d)
+            flash(f"Saved sale for {d}.", "success")
         except Exception as e:
             db.session.rollback()
             flash(f"Could not save sale: {e}", "error")
         return redirect(url_for("sales"))
 
-    rows = DailySale.query.order_by(DailySale.sale_date.desc()).limit(90).all()
-    return render_template("sales.html", rows=rows)
+    page = max(request.args.get("page", 1, type=int), 1)
+    rows = db.session.execute(
+        select(
+            DailySale.id,
+            DailySale.sale_date,
+            DailySale.day_name,
+            DailySale.total_sales,
+            DailySale.daily_profit,
+        )
+        .order_by(DailySale.sale_date.desc())
+        .limit(SALES_PER_PAGE + 1)
+        .offset((page - 1) * SALES_PER_PAGE)
+    ).all()
+    return render_template(
+        "sales.html",
+        rows=rows[:SALES_PER_PAGE],
+        page=page,
+        has_next=len(rows) > SALES_PER_PAGE,
+    )
 
 
 @app.route("/sales/<int:sale_id>/edit", methods=["GET", "POST"])
@@ -219,11 +378,14 @@ def edit_sale(sale_id: int):
             if other:
                 raise ValueError("Another sale entry already exists for that date.")
 
+            old_date = sale.sale_date
             sale.sale_date = d
+            sale.day_name = d.strftime("%A")
             sale.total_sales = total_sales
             sale.daily_profit = daily_profit
 
             db.session.commit()
+            invalidate_months(old_date, d)
             flash("Sale updated.", "success")
             return redirect(url_for("sales"))
         except Exception as e:
@@ -238,8 +400,10 @@ def edit_sale(sale_id: int):
 def delete_sale(sale_id: int):
     sale = DailySale.query.get_or_404(sale_id)
     try:
+        sale_date = sale.sale_date
         db.session.delete(sale)
         db.session.commit()
+        invalidate_months(sale_date)
         flash("Sale deleted.", "success")
     except Exception as e:
         db.session.rollback()
@@ -261,8 +425,9 @@ def expenses():
             if amt < 0:
                 raise ValueError("Amount must be non-negative.")
 
-            db.session.add(Expense(expense_date=d, description=desc, amount=amt))
+            db.session.execute(insert(Expense).values(expense_date=d, description=desc, amount=amt))
             db.session.commit()
+            invalidate_months(d)
             flash("Added expense.", "success")
         except Exception as e:
             db.session.rollback()
@@ -270,8 +435,70 @@ def expenses():
 
         return redirect(url_for("expenses"))
 
-    rows = Expense.query.order_by(Expense.expense_date.desc(), Expense.id.desc()).limit(150).all()
-    return render_template("expenses.html", rows=rows)
+    page = max(request.args.get("page", 1, type=int), 1)
+    rows = db.session.execute(
+        select(Expense.id, Expense.expense_date, Expense.description, Expense.amount)
+        .order_by(Expense.expense_date.desc(), Expense.id.desc())
+        .limit(EXPENSES_PER_PAGE + 1)
+        .offset((page - 1) * EXPENSES_PER_PAGE)
+    ).all()
+    return render_template(
+        "expenses.html",
+        rows=rows[:EXPENSES_PER_PAGE],
+        page=page,
+        has_next=len(rows) > EXPENSES_PER_PAGE,
+    )
+
+
+BULK_BATCH_SIZE = 1000
+
+
+@app.route("/expenses/bulk", methods=["POST"])
+@login_required_simple
+def bulk_expenses():
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        flash("Choose a CSV file to import.", "error")
+        return redirect(url_for("expenses"))
+
+    batch: list[dict] = []
+    months: set[date] = set()
+    count = 0
+    try:
+        reader = csv.reader(TextIOWrapper(upload.stream, encoding="utf-8-sig"))
+        for line_no, row in enumerate(reader, start=1):
+            if not row or (line_no == 1 and row[0].strip().lower() == "date"):
+                continue
+            try:
+                raw_date, desc, raw_amt = row
+                d = parse_date(raw_date.strip())
+                desc = desc.strip()
+                amt = float(raw_amt)
+                if not desc:
+                    raise ValueError("Description is required.")
+                if amt < 0:
+                    raise ValueError("Amount must be non-negative.")
+            except ValueError as e:
+                raise ValueError(f"line {line_no}: {e}") from e
+
+            batch.append({"expense_date": d, "description": desc, "amount": amt})
+            months.add(d.replace(day=1))
+            if len(batch) >= BULK_BATCH_SIZE:
+                db.session.bulk_insert_mappings(Expense, batch)
+                count += len(batch)
+                batch.clear()
+
+        if batch:
+            db.session.bulk_insert_mappings(Expense, batch)
+            count += len(batch)
+        db.session.commit()
+        invalidate_months(*months)
+        flash(f"Imported {count} expenses.", "success")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Could not import expenses: {e}", "error")
+
+    return redirect(url_for("expenses"))
 
 
 @app.route("/expenses/<int:expense_id>/edit", methods=["GET", "POST"])
@@ -290,11 +517,13 @@ def edit_expense(expense_id: int):
             if amt < 0:
                 raise ValueError("Amount must be non-negative.")
 
+            old_date = exp.expense_date
             exp.expense_date = d
             exp.description = desc
             exp.amount = amt
 
             db.session.commit()
+            invalidate_months(old_date, d)
             flash("Expense updated.", "success")
             return redirect(url_for("expenses"))
         except Exception as e:
@@ -309,8 +538,10 @@ def edit_expense(expense_id: int):
 def delete_expense(expense_id: int):
     exp = Expense.query.get_or_404(expense_id)
     try:
+        expense_date = exp.expense_date
         db.session.delete(exp)
         db.session.commit()
+        invalidate_months(expense_date)
         flash("Expense deleted.", "success")
     except Exception as e:
         db.session.rollback()
@@ -330,38 +561,30 @@ def summary():
         month = default_month
         start, end = month_bounds(default_month)
         flash("Invalid month selected; showing current month instead.", "info")
+    month = start.strftime("%Y-%m")
 
-    total_sales = (
-        db.session.query(func.coalesce(func.sum(DailySale.total_sales), 0.0))
-        .filter(DailySale.sale_date.between(start, end))
-        .scalar()
-    )
-    total_profit = (
-        db.session.query(func.coalesce(func.sum(DailySale.daily_profit), 0.0))
-        .filter(DailySale.sale_date.between(start, end))
-        .scalar()
-    )
-    total_expenses = (
-        db.session.query(func.coalesce(func.sum(Expense.amount), 0.0))
-        .filter(Expense.expense_date.between(start, end))
-        .scalar()
-    )
+    with _cache_lock:
+        context = _SUMMARY_CACHE.get(month)
+        generation = _month_generation.get(month, 0)
+    if context is None:
+        context = _load_summary(month, start, end)
+        with _cache_lock:
+            if _month_generation.get(month, 0) == generation:
+                _SUMMARY_CACHE[month] = context
 
-    net_profit = float(total_profit) - float(total_expenses)
+    return render_template("summary.html", **context)
 
-    sales_rows = (
-        DailySale.query.filter(DailySale.sale_date.between(start, end))
-        .order_by(DailySale.sale_date.asc())
-        .all()
-    )
-    expense_rows = (
-        Expense.query.filter(Expense.expense_date.between(start, end))
-        .order_by(Expense.expense_date.asc(), Expense.id.asc())
-        .all()
-    )
 
-    return render_template(
-        "summary.html",
+def _load_summary(month: str, start: date, end: date) -> dict:
+    sales_rows, expense_rows = month_rows(start, end)
+
+    # Totals come from the rows we already loaded, so no extra SUM round-trips.
+    total_sales = sum(r.total_sales for r in sales_rows)
+    total_profit = sum(r.daily_profit for r in sales_rows)
+    total_expenses = sum(e.amount for e in expense_rows)
+    net_profit = float(total_profit) - float(total_expenses)
+
+    return dict(
         month=month,
         start=start,
         end=end,
@@ -379,22 +602,33 @@ def summary():
 @app.route("/export/sales.csv")
 @login_required_simple
 def export_sales_csv():
-    rows = DailySale.query.order_by(DailySale.sale_date.asc()).all()
-    data = [
-        [r.sale_date.isoformat(), r.day_name, f"{r.total_sales:.2f}", f"{r.daily_profit:.2f}"]
-        for r in rows
-    ]
+    rows = db.session.execute(
+        select(DailySale.sale_date, DailySale.day_name, DailySale.total_sales, DailySale.daily_profit)
+        .order_by(DailySale.sale_date.asc())
+        .execution_options(yield_per=1000)
+    )
+    data = (
+        [d.isoformat(), day_name, f"{total_sales:.2f}", f"{daily_profit:.2f}"]
+        for d, day_name, total_sales, daily_profit in rows
+    )
     return csv_response("daily_sales.csv", ["date", "day", "total_sales", "daily_profit"], data)
 
 
 @app.route("/export/expenses.csv")
 @login_required_simple
 def export_expenses_csv():
-    rows = Expense.query.order_by(Expense.expense_date.asc(), Expense.id.asc()).all()
-    data = [[r.expense_date.isoformat(), r.description, f"{r.amount:.2f}"] for r in rows]
+    rows = db.session.execute(
+        select(Expense.expense_date, Expense.description, Expense.amount)
+        .order_by(Expense.expense_date.asc(), Expense.id.asc())
+        .execution_options(yield_per=1000)
+    )
+    data = ([d.isoformat(), desc, f"{amount:.2f}"] for d, desc, amount in rows)
     return csv_response("expenses.csv", ["date", "description", "amount"], data)
 
 
+SUMMARY_CSV_HEADER = "month,total_sales,total_expenses,total_daily_profit,net_profit\r\n"
+
+
 @app.route("/export/summary.csv")
 @login_required_simple
 def export_summary_csv():
@@ -406,48 +640,88 @@ def export_summary_csv():
     except Exception:
         month = default_month
         start, end = month_bounds(default_month)
+    # Re-derive from the parsed date so the value is strictly YYYY-MM and
+    # safe to write without CSV quoting.
+    month = start.strftime("%Y-%m")
 
-    total_sales = (
-        db.session.query(func.coalesce(func.sum(DailySale.total_sales), 0.0))
-        .filter(DailySale.sale_date.between(start, end))
-        .scalar()
-    )
-    total_profit = (
-        db.session.query(func.coalesce(func.sum(DailySale.daily_profit), 0.0))
-        .filter(DailySale.sale_date.between(start, end))
-        .scalar()
-    )
-    total_expenses = (
-        db.session.query(func.coalesce(func.sum(Expense.amount), 0.0))
-        .filter(Expense.expense_date.between(start, end))
-        .scalar()
-    )
+    total_sales, total_profit, total_expenses = month_totals(start, end)
     net_profit = float(total_profit) - float(total_expenses)
 
-    return csv_response(
-        f"summary_{month}.csv",
-        ["month", "total_sales", "total_expenses", "total_daily_profit", "net_profit"],
-        [[
-            month,
-            f"{float(total_sales):.2f}",
-            f"{float(total_expenses):.2f}",
-            f"{float(total_profit):.2f}",
-            f"{net_profit:.2f}",
-        ]],
+    # Fixed one-row schema: format it directly rather than going through csv.writer.
+    body = (
+        SUMMARY_CSV_HEADER
+        + f"{month},{float(total_sales):.2f},{float(total_expenses):.2f},"
+        f"{float(total_profit):.2f},{net_profit:.2f}\r\n"
+    )
+    return Response(
+        body,
+        mimetype="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="summary_{month}.csv"'},
     )
 
 
 @app.route("/backup/db")
 @login_required_simple
 def backup_db():
-    db_path = os.path.join(BASE_DIR, "barbook.db")
-    if not os.path.exists(db_path):
+    if not os.path.exists(DB_PATH):
         abort(404, "Database file not found yet. Run the app once and add some entries.")
-    return send_file(db_path, as_attachment=True, download_name="barbook_backup.db")
+    # In WAL mode the main file can lag behind committed writes (a checkpoint
+    # can't complete while a reader holds a snapshot), so copy a consistent
+    # snapshot with SQLite's online backup API and send that instead.
+    fd, snapshot_path = tempfile.mkstemp(dir=DATA_DIR, suffix=".db")
+    os.close(fd)
+    try:
+        src = sqlite3.connect(DB_PATH)
+        dest = sqlite3.connect(snapshot_path)
+        try:
+            src.backup(dest)
+        finally:
+            dest.close()
+            src.close()
+        snapshot = open(snapshot_path, "rb")
+    finally:
+        # The open handle keeps the data readable until send_file closes it.
+        os.unlink(snapshot_path)
+    return send_file(snapshot, as_attachment=True, download_name="barbook_backup.db")
 
 # -------------------
 # Monthly Close PDF (protected)
 # -------------------
+# ReportLab styles are immutable once built, so share them across renders.
+_STYLES = getSampleStyleSheet()
+_SUMMARY_TABLE_STYLE = TableStyle(
+    [
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+        ("FONTNAME", (0, 0), (-1, -1), "Helvetica"),
+        ("FONTSIZE", (0, 0), (-1, -1), 10),
+        ("ALIGN", (0, 0), (0, -1), "LEFT"),
+        ("ALIGN", (1, 0), (1, -1), "RIGHT"),
+        ("BACKGROUND", (0, -1), (-1, -1), colors.lightgrey),
+        ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+    ]
+)
+_SALES_TABLE_STYLE = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("ALIGN", (2, 1), (-1, -1), "RIGHT"),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f7f7f7")]),
+    ]
+)
+_EXP_TABLE_STYLE = TableStyle(
+    [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("ALIGN", (2, 1), (2, -1), "RIGHT"),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f7f7f7")]),
+    ]
+)
+
+
 @app.route("/report/monthly.pdf")
 @login_required_simple
 def monthly_close_pdf():
@@ -459,34 +733,37 @@ def monthly_close_pdf():
     except Exception:
         month = default_month
         start, end = month_bounds(default_month)
-
-    total_sales = (
-        db.session.query(func.coalesce(func.sum(DailySale.total_sales), 0.0))
-        .filter(DailySale.sale_date.between(start, end))
-        .scalar()
-    )
-    total_profit = (
-        db.session.query(func.coalesce(func.sum(DailySale.daily_profit), 0.0))
-        .filter(DailySale.sale_date.between(start, end))
-        .scalar()
-    )
-    total_expenses = (
-        db.session.query(func.coalesce(func.sum(Expense.amount), 0.0))
-        .filter(Expense.expense_date.between(start, end))
-        .scalar()
+    month = start.strftime("%Y-%m")
+
+    # Closed months rarely change, so they get a long TTL; the current month
+    # is still being filled in and only gets a short one.
+    cache = _CLOSED_PDF_CACHE if month < default_month else _PDF_CACHE
+    with _cache_lock:
+        pdf = cache.get(month)
+        generation = _month_generation.get(month, 0)
+    if pdf is None:
+        pdf = _render_pdf(month, start, end)
+        with _cache_lock:
+            if _month_generation.get(month, 0) == generation:
+                cache[month] = pdf
+
+    # BytesIO over immutable bytes shares the cached buffer, and Werkzeug's
+    # file wrapper streams it out in chunks.
+    return send_file(
+        BytesIO(pdf),
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=f"monthly_close_{month}.pdf",
     )
-    net_profit = float(total_profit) - float(total_expenses)
 
-    sales_rows = (
-        DailySale.query.filter(DailySale.sale_date.between(start, end))
-        .order_by(DailySale.sale_date.asc())
-        .all()
-    )
-    expense_rows = (
-        Expense.query.filter(Expense.expense_date.between(start, end))
-        .order_by(Expense.expense_date.asc(), Expense.id.asc())
-        .all()
-    )
+
+def _render_pdf(month: str, start: date, end: date) -> bytes:
+    sales_rows, expense_rows = month_rows(start, end)
+
+    total_sales = sum(r.total_sales for r in sales_rows)
+    total_profit = sum(r.daily_profit for r in sales_rows)
+    total_expenses = sum(e.amount for e in expense_rows)
+    net_profit = float(total_profit) - float(total_expenses)
 
     buffer = BytesIO()
     doc = SimpleDocTemplate(
@@ -499,7 +776,7 @@ def monthly_close_pdf():
         title=f"Monthly Close - {month}",
     )
 
-    styles = getSampleStyleSheet()
+    styles = _STYLES
     story = []
 
     story.append(Paragraph("<b>Monthly Close Report</b>", styles["Title"]))
@@ -515,76 +792,40 @@ def monthly_close_pdf():
         ["Net Profit", f"{float(net_profit):.2f}"],
     ]
     summary_table = Table(summary_data, colWidths=[80 * mm, 80 * mm])
-    summary_table.setStyle(
-        TableStyle(
-            [
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("FONTNAME", (0, 0), (-1, -1), "Helvetica"),
-                ("FONTSIZE", (0, 0), (-1, -1), 10),
-                ("ALIGN", (0, 0), (0, -1), "LEFT"),
-                ("ALIGN", (1, 0), (1, -1), "RIGHT"),
-                ("BACKGROUND", (0, -1), (-1, -1), colors.lightgrey),
-                ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
-            ]
-        )
-    )
+    summary_table.setStyle(_SUMMARY_TABLE_STYLE)
     story.append(summary_table)
     story.append(Spacer(1, 14))
 
     story.append(Paragraph("<b>Daily Sales</b>", styles["Heading2"]))
-    sales_data = [["Date", "Day", "Total Sales", "Daily Profit"]]
-    for r in sales_rows:
-        sales_data.append([r.sale_date.isoformat(), r.day_name, f"{r.total_sales:.2f}", f"{r.daily_profit:.2f}"])
+    sales_data = [
+        ("Date", "Day", "Total Sales", "Daily Profit"),
+        *(
+            (r.sale_date.isoformat(), r.day_name, f"{r.total_sales:.2f}", f"{r.daily_profit:.2f}")
+            for r in sales_rows
+        ),
+    ]
     if len(sales_data) == 1:
-        sales_data.append(["-", "-", "0.00", "0.00"])
-
-    sales_table = Table(sales_data, colWidths=[32 * mm, 34 * mm, 50 * mm, 50 * mm])
-    sales_table.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
-                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-                ("FONTSIZE", (0, 0), (-1, -1), 9),
-                ("ALIGN", (2, 1), (-1, -1), "RIGHT"),
-                ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f7f7f7")]),
-            ]
-        )
-    )
+        sales_data.append(("-", "-", "0.00", "0.00"))
+
+    sales_table = Table(sales_data, colWidths=[32 * mm, 34 * mm, 50 * mm, 50 * mm], repeatRows=1)
+    sales_table.setStyle(_SALES_TABLE_STYLE)
     story.append(sales_table)
     story.append(Spacer(1, 14))
 
     story.append(Paragraph("<b>Expenses</b>", styles["Heading2"]))
-    exp_data = [["Date", "Description", "Amount"]]
-    for e in expense_rows:
-        exp_data.append([e.expense_date.isoformat(), e.description, f"{e.amount:.2f}"])
+    exp_data = [
+        ("Date", "Description", "Amount"),
+        *((e.expense_date.isoformat(), e.description, f"{e.amount:.2f}") for e in expense_rows),
+    ]
     if len(exp_data) == 1:
-        exp_data.append(["-", "-", "0.00"])
-
-    exp_table = Table(exp_data, colWidths=[32 * mm, 104 * mm, 30 * mm])
-    exp_table.setStyle(
-        TableStyle(
-            [
-                ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
-                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-                ("FONTSIZE", (0, 0), (-1, -1), 9),
-                ("ALIGN", (2, 1), (2, -1), "RIGHT"),
-                ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f7f7f7")]),
-            ]
-        )
-    )
+        exp_data.append(("-", "-", "0.00"))
+
+    exp_table = Table(exp_data, colWidths=[32 * mm, 104 * mm, 30 * mm], repeatRows=1)
+    exp_table.setStyle(_EXP_TABLE_STYLE)
     story.append(exp_table)
 
     doc.build(story)
-    buffer.seek(0)
-
-    filename = f"monthly_close_{month}.pdf"
-    return Response(
-        buffer.getvalue(),
-        mimetype="application/pdf",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-    )
+    return buffer.getvalue()
 
 # -------------------
 # Entrypoint
@@ -593,6 +834,25 @@ def monthly_close_pdf():
 # Ensure DB tables exist in production (e.g., when started via Gunicorn)
 with app.app_context():
     db.create_all()
+    # create_all() skips tables that already exist, so bring older databases
+    # onto the composite expense index explicitly.
+    for index in Expense.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_expenses_expense_date"))
+
+        # day_name used to be computed on read; add and backfill it on older databases.
+        columns = {c["name"] for c in inspect(conn).get_columns("daily_sales")}
+        if "day_name" not in columns:
+            conn.execute(
+                text("ALTER TABLE daily_sales ADD COLUMN day_name VARCHAR(9) NOT NULL DEFAULT ''")
+            )
+            rows = conn.execute(select(DailySale.id, DailySale.sale_date)).all()
+            if rows:
+                conn.execute(
+                    update(DailySale).where(DailySale.id == bindparam("row_id")),
+                    [{"row_id": r.id, "day_name": r.sale_date.strftime("%A")} for r in rows],
+                )
 
 if __name__ == "__main__":
     app.run(debug=True)